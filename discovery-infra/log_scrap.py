@@ -3,14 +3,18 @@
 import re
 import os
 import time
-import json
 import yaml
+import orjson
 import random
 import urllib3
 import logging
+import threading
 import hashlib
-import tempfile
 import elasticsearch
+import collections
+from elasticsearch import helpers
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import SerializationError
 
 from logger import log
 from shutil import copyfile
@@ -20,33 +24,76 @@ from monitoring import process
 from contextlib import suppress
 from argparse import ArgumentParser
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import assisted_service_client
 from test_infra.assisted_service_api import InventoryClient, create_client
 
 RETRY_INTERVAL = 60 * 5
+RETRY_BASE_INTERVAL = 5
+RETRY_JITTER = 5
 MAX_EVENTS = 1000
+VERSIONS_CACHE_TTL = 60 * 5
+ES_TIMEOUT = 60
+ES_MAX_RETRIES = 3
+BULK_CHUNK_SIZE = 500
+BULK_MAX_RETRIES = 3
+CLUSTER_WORKERS = 4
 INDEX = "assisted-service-events"
+CHECKPOINT_FILE = "checkpoint.json"
 
 FMT = '%Y-%m-%dT%H:%M:%S.%fZ'
-UUID_REGEX = r'[a-f0-9]{8}-?[a-f0-9]{4}-?4[a-f0-9]{3}-?[89ab][a-f0-9]{3}-?[a-f0-9]{12}'
+# Bounded by non-hex characters only, so UUIDs glued to words like "cluster_<uuid>" are still scrubbed
+UUID_REGEX = re.compile(r'(?<![a-f0-9])[a-f0-9]{8}-[a-f0-9]{4}-4[a-f0-9]{3}-[89ab][a-f0-9]{3}-[a-f0-9]{12}(?![a-f0-9])')
+UUID_NO_DASH_REGEX = re.compile(r'(?<![a-f0-9])[a-f0-9]{12}4[a-f0-9]{3}[89ab][a-f0-9]{15}(?![a-f0-9])')
+HOST_PREFIX_REGEX = re.compile(r"^Host \S+:")
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 es_logger = logging.getLogger('elasticsearch')
 es_logger.setLevel(logging.WARNING)
 
+class OrjsonSerializer(JSONSerializer):
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        # Bulk helpers measure and join the serialized actions as text, so a str is returned
+        if isinstance(data, str):
+            return data
+        try:
+            return orjson.dumps(data, default=self.default).decode("utf-8")
+        except orjson.JSONEncodeError as e:
+            raise SerializationError(data, e)
+
+
 class ScrapeEvents:
-    def __init__(self, inventory_url: str, es_server: str, es_user:str, es_pass:str, backup_destination: str):
+    def __init__(self, inventory_url: str, es_server: str, es_user:str, es_pass:str, backup_destination: str,
+                 pretty_backups: bool = False):
         self.client = create_client(url=inventory_url)
+        self._versions_cache = (0.0, None)
+        self._versions_lock = threading.Lock()
 
         self.index = INDEX
-        self.es = elasticsearch.Elasticsearch(es_server, http_auth=(es_user, es_pass))
+        self.es = elasticsearch.Elasticsearch(es_server, http_auth=(es_user, es_pass), serializer=OrjsonSerializer(),
+                                              http_compress=True, timeout=ES_TIMEOUT, retry_on_timeout=True,
+                                              max_retries=ES_MAX_RETRIES)
 
         self.backup_destination = backup_destination
-        if self.backup_destination and not os.path.exists(self.backup_destination):
-            os.makedirs(self.backup_destination)
+        self.backup_dump_option = orjson.OPT_INDENT_2 if pretty_backups else None
+        if self.backup_destination:
+            os.makedirs(self.backup_destination, exist_ok=True)
 
+        # Time of the latest indexed event per cluster, kept next to the backups when those are enabled
+        # and only in memory otherwise
+        self.checkpoint_path = os.path.join(self.backup_destination, CHECKPOINT_FILE) if self.backup_destination else None
+        self.checkpoint = self.load_checkpoint()
+        self.sweep_checkpoint = dict()
+        self.sweep_doc_clusters = dict()
+        self.completed_sweeps = 0
 
     def run_service(self):
 
@@ -59,24 +106,78 @@ class ScrapeEvents:
                 time.sleep(RETRY_INTERVAL)
                 break
 
-            cluster_count = len(clusters)
-            for i, cluster in enumerate(clusters):
-                cluster_id = cluster["id"]
-                log.info(f"{i}/{cluster_count}: Starting process of cluster {cluster_id}")
-                self.process_cluster(cluster)
+            self.sweep_checkpoint = dict()
+            self.sweep_doc_clusters = dict()
+            failures = self.log_docs(self.get_clusters_actions(clusters))
+            if failures:
+                log.warn(f"Failed to log {failures} events, keeping the previous checkpoint of their clusters")
+
+            self.checkpoint.update(self.sweep_checkpoint)
+            self.save_checkpoint()
+            self.completed_sweeps += 1
+
+    def load_checkpoint(self):
+        if not self.checkpoint_path:
+            return dict()
+
+        with FileLock(f"{self.checkpoint_path}.lock"):
+            with suppress(FileNotFoundError):
+                with open(self.checkpoint_path, "rb") as f:
+                    return orjson.loads(f.read())
+        return dict()
+
+    def save_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+
+        with FileLock(f"{self.checkpoint_path}.lock"):
+            write_file_atomically(self.checkpoint_path, orjson.dumps(self.checkpoint))
+
+    def get_clusters_actions(self, clusters):
+        # Clusters are downloaded and processed by a pool of workers while their actions are being indexed,
+        # only a bounded number of processed clusters is kept waiting for the bulk consumer
+        cluster_count = len(clusters)
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=CLUSTER_WORKERS) as executor:
+            try:
+                for i, cluster in enumerate(clusters):
+                    pending.append((cluster["id"], executor.submit(self.process_cluster, cluster, f"{i}/{cluster_count}")))
+                    if len(pending) >= CLUSTER_WORKERS * 2:
+                        yield from self.get_cluster_actions(*pending.popleft())
+
+                while pending:
+                    yield from self.get_cluster_actions(*pending.popleft())
+            finally:
+                # Closed early when indexing fails, the clusters that were not started yet are not processed at all
+                for _, future in pending:
+                    future.cancel()
+
+    def get_cluster_actions(self, cluster_id, future):
+        # A broken cluster must not abort the sweep for the clusters after it
+        try:
+            yield from future.result()
+        except Exception:
+            log.exception(f"Failed to process cluster {cluster_id}, skipping it")
+            self.sweep_checkpoint.pop(cluster_id, None)
 
     def get_metadata_json(self, cluster: dict):
         d = {'cluster': cluster}
-        d.update(self.client.get_versions())
+        d.update(self._cached_versions())
         return d
 
-    def process_cluster(self, cluster):
-        with tempfile.NamedTemporaryFile() as temp_event_file:
-            self.write_events_file(cluster, temp_event_file.name)
-            with open(temp_event_file.name) as f:
-                event_list = json.load(f)
+    def _cached_versions(self):
+        # Versions only change when the service is redeployed, no need to fetch them for every cluster
+        with self._versions_lock:
+            fetch_time, versions = self._versions_cache
+            if versions is None or time.monotonic() - fetch_time > VERSIONS_CACHE_TTL:
+                versions = self.client.get_versions()
+                self._versions_cache = (time.monotonic(), versions)
+            return versions
 
-        self.elastefy_events(cluster, event_list)
+    def process_cluster(self, cluster, progress=""):
+        log.info(f"{progress}: Starting process of cluster {cluster['id']}")
+        event_list = self.get_events(cluster)
+        return self.elastefy_events(cluster, event_list)
 
     def elastefy_events(self, cluster, event_list):
 
@@ -85,61 +186,102 @@ class ScrapeEvents:
         event_count = len(event_list)
         if event_count > MAX_EVENTS:
             log.info(f"Cluster {cluster_id} has {event_count} event records, logging only {MAX_EVENTS}")
-            event_list = event_list[:MAX_EVENTS]
+            event_list = event_list[-MAX_EVENTS:]
 
         metadata_json = self.get_metadata_json(cluster)
 
         if self.backup_destination:
             self.save_new_backup(cluster_id, event_list, metadata_json)
 
+        # Event times share a fixed-width ISO format, so comparing them as strings keeps them in time order
+        last_event_time = self.checkpoint.get(cluster_id, "")
+        # Events sharing the checkpoint's time may have arrived after it was taken, the ones already logged are
+        # rejected as conflicts
+        event_list = [event for event in event_list if event["event_time"] >= last_event_time]
+        if not event_list:
+            return []
+        self.sweep_checkpoint[cluster_id] = max(event["event_time"] for event in event_list)
+
         cluster_bash_data = process_metadata(metadata_json)
-        event_names = get_cluster_object_names(cluster_bash_data)
+        names_regex = get_names_regex(get_cluster_object_names(cluster_bash_data))
+
+        return self.get_bulk_actions(cluster_id, event_list, cluster_bash_data, names_regex)
 
-        for event in event_list[::-1]:
+    def get_bulk_actions(self, cluster_id, event_list, cluster_bash_data, names_regex):
+        for event in reversed(event_list):
             if process.is_event_skippable(event):
                 continue
+            doc = {**cluster_bash_data, **event, "no_name_message": get_no_name_message(event["message"], names_regex)}
             doc_id = get_doc_id(event)
-            cluster_bash_data["no_name_message"] = get_no_name_message(event["message"], event_names)
-            process_event_doc(event, cluster_bash_data)
-            ret = self.log_doc(cluster_bash_data, doc_id)
-            if not ret:
-                break
+            self.sweep_doc_clusters[doc_id] = cluster_id
+            yield {
+                "_op_type": "create",
+                "_index": self.index,
+                "_id": doc_id,
+                "_source": doc,
+            }
 
     def save_new_backup(self,cluster_id, event_list, metadata_json):
         cluster_backup_directory_path = os.path.join(self.backup_destination, f"cluster_{cluster_id}")
-        if not os.path.exists(cluster_backup_directory_path):
-            os.makedirs(cluster_backup_directory_path)
+        os.makedirs(cluster_backup_directory_path, exist_ok=True)
 
         event_dest = os.path.join(cluster_backup_directory_path, "events.json")
-        with open(event_dest, "w") as f:
-            json.dump(event_list, f, indent=4)
+        write_file_atomically(event_dest, orjson.dumps(event_list, option=self.backup_dump_option))
 
         metadata_dest = os.path.join(cluster_backup_directory_path, "metadata.json")
-        with open(metadata_dest, "w") as f:
-            json.dump(metadata_json, f, indent=4)
-
-    def log_doc(self, doc, id_):
+        write_file_atomically(metadata_dest, orjson.dumps(metadata_json, option=self.backup_dump_option))
+
+    def log_docs(self, actions):
+        # Already logged events are rejected by the "create" op with a 409 conflict,
+        # so the bulk errors are filtered to those worth reporting.
+        # The actions are pulled in this thread, so a failing request stops the sweep right away
+        # instead of downloading the remaining clusters first
+        failures = 0
         try:
-            res = self.es.create(index=self.index, body=doc, id=id_)
-        except elasticsearch.exceptions.ConflictError:
-            log.debug("Hit logged event")
-            return None
-        return res
-
-    def write_events_file(self, cluster, output_file):
-        with suppress(assisted_service_client.rest.ApiException):
-            self.client.download_cluster_events(cluster['id'], output_file)
+            for ok, result in helpers.streaming_bulk(self.es, actions, chunk_size=BULK_CHUNK_SIZE,
+                                                     max_retries=BULK_MAX_RETRIES, raise_on_error=False):
+                item = result.get("create", {})
+                # Only the ids of the chunks in flight are kept, every result releases its own
+                cluster_id = self.sweep_doc_clusters.pop(item.get("_id"), None)
+                if ok:
+                    continue
+                if item.get("status") == 409:
+                    log.debug("Hit logged event")
+                    continue
+                log.warn(f"Failed to log event {item.get('_id')}: {item.get('error')}")
+                # Only the cluster of the failed event keeps its previous checkpoint and is sent again next sweep
+                self.sweep_checkpoint.pop(cluster_id, None)
+                failures += 1
+        finally:
+            actions.close()
+
+        return failures
+
+    def get_events(self, cluster):
+        # A failed request must not look like a cluster without events, it would overwrite the cluster's backup.
+        # The error is logged when the cluster is skipped
+        return self.client.get_events(cluster['id'])
 
     def get_clusters(self):
         return self.client.get_all_clusters()
 
-def get_no_name_message(event_message: str, event_names: list):
-    for name in event_names:
-        event_message = event_message.replace(name, "Name")
-    event_message = re.sub(UUID_REGEX, "UUID", event_message)
-    event_message = re.sub(r"^Host \S+:", "", event_message)
+def get_no_name_message(event_message: str, names_regex):
+    if names_regex:
+        event_message = names_regex.sub("Name", event_message)
+    event_message = UUID_REGEX.sub("UUID", event_message)
+    event_message = UUID_NO_DASH_REGEX.sub("UUID", event_message)
+    event_message = HOST_PREFIX_REGEX.sub("", event_message)
     return event_message
 
+def get_names_regex(names: list):
+    # Longer names first, so a name that contains another one is replaced as a whole.
+    # The compiled alternation checks each position against the set of the names' first characters before trying
+    # them, and sub() hands back the message as is when nothing matches, so messages without names stay cheap
+    names = sorted(filter(None, set(names)), key=len, reverse=True)
+    if not names:
+        return None
+    return re.compile("|".join(map(re.escape, names)))
+
 def get_cluster_object_names(cluster_bash_data):
     strings_to_remove = list()
     for host in cluster_bash_data["cluster"]["hosts"]:
@@ -154,12 +296,17 @@ def process_metadata(metadata_json):
     return p.get_processed_json()
 
 def get_doc_id(event_json):
+    # Events are only deduplicated by this id, so any change to it makes every indexed event look new.
+    # Rebuild the index when rolling out a new id scheme, or the first sweep duplicates all the events
     id_str = event_json["event_time"] + event_json["cluster_id"] + event_json["message"]
-    _id = int(hashlib.md5(id_str.encode('utf-8')).hexdigest(), 16)
-    return str(_id)
+    return hashlib.blake2b(id_str.encode('utf-8'), digest_size=16).hexdigest()
 
-def process_event_doc(event_data, cluster_bash_data):
-    cluster_bash_data.update(event_data)
+def write_file_atomically(path, data: bytes):
+    # A crash mid-write leaves only the temporary file behind, never a truncated backup
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
 
 
 def handle_arguments():
@@ -169,23 +316,39 @@ def handle_arguments():
     parser.add_argument("-eu", "--es_user", help="Elasticsearch user", type=str)
     parser.add_argument("-ep", "--es_pass", help="Elasticsearch password", type=str)
     parser.add_argument("--backup-destination", help="Path to save backup, if empty no back up saved", default=None, type=str)
+    parser.add_argument("--pretty-backups", help="Indent backup files for human inspection", action="store_true")
 
     return parser.parse_args()
 
 def main():
     args = handle_arguments()
 
+    # Clients are kept across retries and only recreated when the connection itself is at fault
+    scrape_events = None
+    failures = 0
     while True:
+        completed_sweeps = 0
         try:
-            scrape_events = ScrapeEvents(inventory_url=args.inventory_url,
-                                         es_server=args.es_server,
-                                         es_user = args.es_user,
-                                         es_pass = args.es_pass,
-                                         backup_destination=args.backup_destination)
+            if scrape_events is None:
+                scrape_events = ScrapeEvents(inventory_url=args.inventory_url,
+                                             es_server=args.es_server,
+                                             es_user = args.es_user,
+                                             es_pass = args.es_pass,
+                                             backup_destination=args.backup_destination,
+                                             pretty_backups=args.pretty_backups)
+            completed_sweeps = scrape_events.completed_sweeps
             scrape_events.run_service()
+            failures = 0
         except Exception as EX:
-            log.warn(f"Elastefying logs failed with error {EX}, sleeping for {RETRY_INTERVAL} and retrying")
-            time.sleep(RETRY_INTERVAL)
+            if scrape_events and scrape_events.completed_sweeps > completed_sweeps:
+                failures = 0
+            if isinstance(EX, elasticsearch.exceptions.ConnectionError):
+                scrape_events = None
+
+            backoff = min(RETRY_INTERVAL, RETRY_BASE_INTERVAL * 2 ** failures) + random.uniform(0, RETRY_JITTER)
+            failures += 1
+            log.warn(f"Elastefying logs failed with error {EX}, sleeping for {backoff:.0f} and retrying")
+            time.sleep(backoff)
 
 if __name__ == '__main__':
     main()
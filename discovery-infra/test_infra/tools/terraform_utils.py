@@ -1,6 +1,7 @@
 import json
 import logging
 import os
+from contextlib import contextmanager
 
 from python_terraform import Terraform, IsFlagged
 
@@ -13,6 +14,9 @@ class TerraformUtils:
         logging.info("TF FOLDER %s ", working_dir)
         self.working_dir = working_dir
         self.var_file_path = os.path.join(working_dir, self.VAR_FILE)
+        self.state_file_path = os.path.join(working_dir, self.STATE_FILE)
+        self._state_cache = (None, None)
+        self._pending_variables = None
         self.tf = Terraform(working_dir=working_dir, state=self.STATE_FILE, var_file=self.VAR_FILE)
         self.init_tf()
 
@@ -28,17 +32,61 @@ class TerraformUtils:
             raise Exception(message)
 
     def change_variables(self, variables, refresh=True):
-        with open(self.var_file_path, "r+") as _file:
+        if self._pending_variables is not None:
+            self._pending_variables.update(variables)
+            return
+
+        with open(self.var_file_path, "r") as _file:
             tfvars = json.load(_file)
-            tfvars.update(variables)
-            _file.seek(0)
-            _file.truncate()
+
+        changed = {key: value for key, value in variables.items() if key not in tfvars or tfvars[key] != value}
+        if not changed:
+            logging.info("Terraform variables %s are already set, skipping apply", list(variables))
+            return
+
+        # The previous values are written back if the apply fails, so a retry with the same values applies again
+        self._write_variables({**tfvars, **changed})
+        try:
+            self.apply(refresh=refresh)
+        except Exception:
+            self._write_variables(tfvars)
+            raise
+
+    def _write_variables(self, tfvars):
+        tmp_var_file_path = f"{self.var_file_path}.tmp"
+        with open(tmp_var_file_path, "w") as _file:
             json.dump(tfvars, _file)
-        self.apply(refresh=refresh)
+        os.replace(tmp_var_file_path, self.var_file_path)
+
+    @contextmanager
+    def deferred_apply(self, refresh=True):
+        """ Collects the variables changed within the block and applies them all at once when it exits """
+        if self._pending_variables is not None:
+            yield self._pending_variables
+            return
+
+        self._pending_variables = dict()
+        try:
+            yield self._pending_variables
+            pending_variables = self._pending_variables
+        finally:
+            self._pending_variables = None
+
+        if pending_variables:
+            self.change_variables(pending_variables, refresh=refresh)
 
     def get_state(self):
-        self.tf.read_state_file(self.STATE_FILE)
-        return self.tf.tfstate
+        # The state file is parsed again only if it was modified since the last read.
+        # The same state object is returned until then, so callers must not modify it
+        try:
+            mtime = os.stat(self.state_file_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        if mtime is None or mtime != self._state_cache[0]:
+            self.tf.read_state_file(self.STATE_FILE)
+            self._state_cache = (mtime, self.tf.tfstate)
+        return self._state_cache[1]
 
     def set_new_vip(self, api_vip):
         self.change_variables(variables={"api_vip": api_vip}, refresh=True)